@@ -1,28 +1,151 @@
 import streamlit as st
+import atexit
+import io
 import sqlite3
+import threading
 import pandas as pd
+from openpyxl import Workbook
 from datetime import datetime, timedelta
 
 DB_NAME = "cosmetic_inventory.db"
 
+# DELETE ... RETURNING 구문은 SQLite 3.35 이상에서만 지원
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+@st.cache_resource
+def get_conn():
+    """
+    프로세스 전체에서 재사용하는 SQLite 연결을 반환합니다.
+    Streamlit은 위젯 조작마다 스크립트를 다시 실행하므로, 매번 연결을 새로 열면
+    파일 열기/PRAGMA 설정/페이지 캐시 적재가 반복됩니다.
+    """
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    # WAL 모드: 읽기가 쓰기를 막지 않고, 쓰기 트랜잭션당 fsync 횟수가 줄어듦
+    # (journal_mode는 DB 파일에 저장되므로 실제로는 최초 1회만 전환됨)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # 아래 설정은 연결 단위로 적용되는 값
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")  # 64MB 페이지 캐시
+    conn.execute("PRAGMA temp_store=MEMORY")
+    # 서버 종료 시 연결을 닫아 -wal 내용을 DB 파일에 반영하고 -wal/-shm 파일을 정리
+    atexit.register(conn.close)
+    return conn
+
+@st.cache_resource
+def get_db_lock():
+    # 여러 세션(스레드)이 같은 연결을 공유하므로 DB 작업을 직렬화
+    # (with_connection 함수 안에서 다른 with_connection 함수를 호출하므로 RLock 사용)
+    return threading.RLock()
+
 def with_connection(func):
     def wrapper(*args, **kwargs):
-        conn = sqlite3.connect(DB_NAME)
-        try:
-            result = func(conn, *args, **kwargs)
-        finally:
-            conn.close()
-        return result
+        with get_db_lock():
+            conn = get_conn()
+            nested = conn.in_transaction
+            try:
+                return func(conn, *args, **kwargs)
+            finally:
+                # 커밋되지 않은 트랜잭션은 되돌려 공유 연결에 남지 않도록 함
+                # (바깥 함수가 진행 중인 트랜잭션은 바깥 함수가 마무리)
+                if not nested and conn.in_transaction:
+                    conn.rollback()
     return wrapper
 
+@st.cache_resource
+def get_data_version():
+    # 테이블별 변경 카운터 (st.cache_data 조회 결과를 쓰기 이후 무효화하는 용도)
+    return {}
+
+def bump_data_version(*table_names):
+    versions = get_data_version()
+    with get_db_lock():
+        for table_name in table_names:
+            versions[table_name] = versions.get(table_name, 0) + 1
+
+def checkpoint_db(conn):
+    # WAL 모드에서는 커밋된 데이터가 -wal 파일에 먼저 쌓이므로,
+    # 엑셀 업로드/내보내기처럼 DB 파일 자체를 기준으로 삼는 시점에 DB 파일로 옮기고 -wal을 비움
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
 ###엑셀 데이터 동기화용 함수####
+# 엑셀 시트명 -> DB 테이블명
+SHEET_TABLE_MAP = {
+    "재고": "inventory",
+    "처방": "formula",
+    "입출고": "transactions",
+    "생산이력": "production_history",
+}
+
+# 테이블별 컬럼 목록 (create_tables_if_not_exist의 스키마 순서와 동일)
+TABLE_COLUMNS = {
+    "inventory": ["id", "원료명", "재고량 (g)", "유통기한", "거래처", "단가 (원/kg)", "MOQ (kg)", "리드타임 (일)"],
+    "formula": ["id", "제품명", "원료명", "사용량 (g/%)"],
+    "transactions": ["id", "원료명", "유형", "수량 (g)", "날짜", "비고"],
+    "production_history": ["id", "제품명", "용량 (g)", "수량", "날짜"],
+}
+
+def quote_ident(name):
+    return '"' + name.replace('"', '""') + '"'
+
+# 내보내기용 SELECT 문: 식별자를 한 번만 인용해 두고, 같은 SQL 문자열을 재사용하여
+# 공유 연결의 statement cache에서 컴파일된 문장을 다시 쓰도록 함
+EXPORT_QUERIES = {
+    table_name: f"SELECT {', '.join(map(quote_ident, cols))} FROM {quote_ident(table_name)}"
+    for table_name, cols in TABLE_COLUMNS.items()
+}
+
+# 내보내기 시 한 번에 DataFrame으로 읽어올 최대 행 수
+EXPORT_CHUNKSIZE = 10000
+
 def sync_sheet_to_db(conn, df_sheet, table_name):
-    # 간단히 replace 로직. 필요 시 병합 등 세부 로직 변경 가능
-    df_sheet.to_sql(table_name, conn, if_exists="append", index=False)
+    """
+    시트 DataFrame을 테이블에 반영합니다. (트랜잭션 시작/커밋은 호출하는 쪽에서 처리)
+    """
+    # 필요시 불필요한 Unnamed 컬럼 제거
+    df_sheet = df_sheet.loc[:, ~df_sheet.columns.str.contains('^Unnamed')].copy()
+
+    # 날짜 컬럼은 앱이 저장하는 것과 같은 'YYYY-MM-DD HH:MM:SS[.ffffff]' 문자열로 변환
+    for c in df_sheet.select_dtypes(include="datetime").columns:
+        df_sheet[c] = df_sheet[c].map(lambda ts: ts.isoformat(sep=" "), na_action="ignore")
+    # NaN/NaT는 NULL로 저장되도록 None으로 변환
+    df_sheet = df_sheet.astype(object).where(df_sheet.notna(), None)
+    data_cols = [c for c in df_sheet.columns if c != "id"]
+    if "id" in df_sheet.columns:
+        has_id = df_sheet["id"].notna()
+    else:
+        has_id = pd.Series(False, index=df_sheet.index)
+
+    # DB 전체를 읽어 병합한 뒤 다시 append 하지 않고, 행 단위로 중복을 걸러서 반영
+    table = quote_ident(table_name)
+    quoted_cols = [quote_ident(c) for c in data_cols]
+    data_list = ", ".join(quoted_cols)
+    # id가 있는 행: 같은 id의 기존 행은 엑셀 값으로 갱신하고, 없으면 추가
+    upsert_sql = (
+        f'INSERT INTO {table} (id, {data_list}) VALUES ({", ".join("?" * (len(data_cols) + 1))}) '
+        f'ON CONFLICT(id) DO UPDATE SET ' + ", ".join(f"{c} = excluded.{c}" for c in quoted_cols)
+    )
+    # id가 없는 행: 모든 값이 같은 행이 이미 있으면 건너뜀 (NULL 비교를 위해 IS 사용)
+    insert_sql = (
+        f'INSERT INTO {table} ({data_list}) SELECT {", ".join("?" * len(data_cols))} '
+        f'WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE '
+        + " AND ".join(f"{c} IS ?" for c in quoted_cols) + ")"
+    )
 
-def db_to_sheet(conn, table_name, sheet_name, writer):
-    df_db = pd.read_sql(f"SELECT * FROM {table_name}", conn)
-    df_db.to_excel(writer, sheet_name=sheet_name, index=False)
+    if has_id.any():
+        conn.executemany(upsert_sql, df_sheet.loc[has_id, ["id"] + data_cols].itertuples(index=False, name=None))
+    conn.executemany(insert_sql, (
+        row + row for row in df_sheet.loc[~has_id, data_cols].itertuples(index=False, name=None)
+    ))
+
+def db_to_sheet(conn, table_name, sheet_name, wb):
+    # wb는 write_only 워크북: 행을 바로 기록하므로 셀 객체 전체를 메모리에 들고 있지 않음
+    ws = wb.create_sheet(sheet_name)
+    ws.append(TABLE_COLUMNS[table_name])
+    # 테이블 전체를 한 번에 올리지 않고 EXPORT_CHUNKSIZE 행씩 읽어서 기록 (메모리 사용량 상한)
+    for chunk in pd.read_sql(EXPORT_QUERIES[table_name], conn, chunksize=EXPORT_CHUNKSIZE):
+        # NaN은 빈 셀로 기록되도록 None으로 변환
+        for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+            ws.append(row)
         
 
 @with_connection
@@ -88,6 +211,11 @@ def create_tables_if_not_exist(conn):
         )
     """)
 
+    # 인덱스: 원료명 기준 재고 갱신, 제품명 기준 처방 조회, 유통기한 임박 조회(유통기한 <= ?)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inv_name ON inventory(원료명)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_formula_prod ON formula(제품명)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_inv_exp ON inventory(유통기한)")
+
     conn.commit()
   
 
@@ -97,35 +225,27 @@ def sync_excel_to_db_with_update(conn, excel_file, sheet_name, table_name):
     # 엑셀 파일에서 데이터 읽어오기
     df_excel = pd.read_excel(excel_file, sheet_name=sheet_name)
 
-    # 필요시 불필요한 Unnamed 컬럼 제거
-    df_excel = df_excel.loc[:, ~df_excel.columns.str.contains('^Unnamed')]
-
-    # 기존 DB 데이터 가져오기
-    try:
-        df_db = pd.read_sql(f"SELECT * FROM {table_name}", conn)
-    except Exception:
-        df_db = pd.DataFrame()
-
-    if not df_db.empty:
-        df_merged = pd.concat([df_db, df_excel]).drop_duplicates(subset=df_excel.columns.tolist(), keep='last')
-    else:
-        df_merged = df_excel
-
-    df_merged.to_sql(table_name, conn, if_exists="append", index=False)
+    conn.execute("BEGIN IMMEDIATE")
+    sync_sheet_to_db(conn, df_excel, table_name)
+    conn.commit()
+    checkpoint_db(conn)
+    bump_data_version(table_name)
     st.success(f"엑셀 데이터({sheet_name})가 데이터베이스({table_name})로 업데이트 및 병합되었습니다.")
 
 # 함수: 데이터베이스 데이터를 엑셀로 내보내기
 @with_connection
 def sync_db_to_excel(conn, table_name, sheet_name):
-    df = pd.read_sql(f"SELECT * FROM {table_name}", conn)
-
-    with pd.ExcelWriter("exported_data.xlsx", engine="openpyxl") as writer:
-        df.to_excel(writer, sheet_name=sheet_name, index=False)
+    wb = Workbook(write_only=True)
+    db_to_sheet(conn, table_name, sheet_name, wb)
+    checkpoint_db(conn)
+    # 임시 파일 없이 메모리 버퍼에 저장한 뒤 바로 다운로드 데이터로 전달
+    buf = io.BytesIO()
+    wb.save(buf)
 
     st.success("엑셀 파일이 생성되었습니다. 아래 버튼을 눌러 다운로드하세요.")
     st.download_button(
         label="엑셀 파일 다운로드",
-        data=open("exported_data.xlsx", "rb").read(),
+        data=buf.getvalue(),
         file_name="exported_data.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     )
@@ -135,8 +255,13 @@ def sync_db_to_excel(conn, table_name, sheet_name):
 ######################
 st.set_page_config(page_title="Cosmetic Inventory", layout="wide")
 
-# 필요하다면, 초기 1회만 아래 함수 호출하여 테이블 구조 보장
-create_tables_if_not_exist()
+# 테이블 구조 보장은 서버 프로세스당 1회만 실행 (매 rerun마다 DDL을 반복하지 않음)
+@st.cache_resource
+def _ensure_schema():
+    create_tables_if_not_exist()
+    return True
+
+_ensure_schema()
 
 menu = st.sidebar.selectbox(
     "메뉴를 선택하세요",
@@ -187,32 +312,32 @@ elif menu == "재고 관리":
         # 수정된 DataFrame의 각 행에 대해 데이터베이스 업데이트 실행
         @with_connection
         def update_inventory_from_df(conn, df):
-            cursor = conn.cursor()
-            # 각 행에 대해 UPDATE 쿼리 실행 (id를 기준으로)
-            for _, row in df.iterrows():
-                update_sql = """
-                    UPDATE inventory
-                    SET 원료명 = ?,
-                        "재고량 (g)" = ?,
-                        유통기한 = ?,
-                        거래처 = ?,
-                        "단가 (원/kg)" = ?,
-                        "MOQ (kg)" = ?,
-                        "리드타임 (일)" = ?
-                    WHERE id = ?
-                """
-                # 유통기한은 문자열 형식(예: 'YYYY-MM-DD')로 저장한다고 가정
-                cursor.execute(update_sql, (
-                    row["원료명"],
-                    row["재고량 (g)"],
-                    str(row["유통기한"]) if pd.notna(row["유통기한"]) else None,
-                    row["거래처"],
-                    row["단가 (원/kg)"],
-                    row["MOQ (kg)"],
-                    row["리드타임 (일)"],
-                    row["id"]
-                ))
+            update_sql = """
+                UPDATE inventory
+                SET 원료명 = ?,
+                    "재고량 (g)" = ?,
+                    유통기한 = ?,
+                    거래처 = ?,
+                    "단가 (원/kg)" = ?,
+                    "MOQ (kg)" = ?,
+                    "리드타임 (일)" = ?
+                WHERE id = ?
+            """
+            # UPDATE 파라미터 순서대로 컬럼 재배치 (id를 기준으로)
+            # id가 없는 행(에디터에서 새로 추가한 행)은 UPDATE 대상이 아니므로 제외
+            params_df = df.loc[df["id"].notna(), [
+                "원료명", "재고량 (g)", "유통기한", "거래처",
+                "단가 (원/kg)", "MOQ (kg)", "리드타임 (일)", "id"
+            ]].astype({"id": "int64"})
+            # 유통기한은 문자열 형식(예: 'YYYY-MM-DD')로 저장한다고 가정
+            params_df["유통기한"] = params_df["유통기한"].map(str, na_action="ignore")
+            # 빈 값(NaN)은 NULL로 저장되도록 None으로 변환
+            params_df = params_df.astype(object).where(params_df.notna(), None)
+            # 전체 UPDATE를 하나의 트랜잭션으로 묶어 커밋(디스크 동기화)을 한 번만 수행
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(update_sql, params_df.itertuples(index=False, name=None))
             conn.commit()
+            bump_data_version("inventory")
         
         update_inventory_from_df(edited_df)
         st.success("수정된 재고 데이터가 저장되었습니다.")
@@ -228,30 +353,26 @@ elif menu == "재고 관리":
         cursor = conn.cursor()
         cursor.execute("UPDATE inventory SET 유통기한 = ? WHERE id = ?", (new_date, row_id))
         conn.commit()
+        bump_data_version("inventory")
 
     st.subheader("유통기한 수정")
     all_inv = get_all_inventory()
     if all_inv.empty:
         st.info("등록된 원료가 없습니다.")
     else:
-        # 표시명 생성: [ID 12] 살구씨오일 (현재: 2025-01-01)
-        all_inv["표시명"] = all_inv.apply(
-            lambda x: f"[ID {x['id']}] {x['원료명']} (현재: {x['유통기한']})",
-            axis=1
+        # id -> 표시명 매핑: [ID 12] 살구씨오일 (현재: 2025-01-01)
+        labels = (
+            "[ID " + all_inv["id"].astype(str) + "] " + all_inv["원료명"]
+            + " (현재: " + all_inv["유통기한"].fillna("None").astype(str) + ")"
         )
-        selected_row = st.selectbox(
+        label_map = dict(zip(all_inv["id"].tolist(), labels.tolist()))
+        # 선택값이 곧 id이므로 표시명에서 다시 파싱할 필요 없음
+        selected_id = st.selectbox(
             "유통기한을 수정할 원료 선택",
-            all_inv["표시명"].tolist()
+            options=list(label_map),
+            format_func=label_map.get
         )
 
-        import re
-        selected_id = None
-        if selected_row:
-            # [ID 12] 형태에서 12를 추출
-            m = re.search(r"\[ID (\d+)\]", selected_row)
-            if m:
-                selected_id = int(m.group(1))
-
         new_date = st.date_input("새 유통기한 설정", value=None)
         if st.button("유통기한 수정"):
             if selected_id:
@@ -268,59 +389,89 @@ elif menu == "입출고 기록":
     ############################################################
 
     @with_connection
-    def get_vendor_list(conn):
-        df = pd.read_sql("SELECT DISTINCT 거래처 FROM inventory WHERE 거래처 IS NOT NULL AND 거래처 != ''", conn)
+    @st.cache_data(ttl=60)
+    def _get_vendor_list(_conn, version):
+        df = pd.read_sql("SELECT DISTINCT 거래처 FROM inventory WHERE 거래처 IS NOT NULL AND 거래처 != ''", _conn)
         vendors = df["거래처"].dropna().unique().tolist()
         return vendors
 
+    def get_vendor_list():
+        return _get_vendor_list(get_data_version().get("inventory", 0))
+
 
     @with_connection
-    def add_new_ingredient(conn, 원료명, 유통기한, 거래처, 단가, MOQ, 리드타임):
-        cursor = conn.cursor()
-        insert_sql = """
-            INSERT INTO inventory
-            (원료명, "재고량 (g)", 유통기한, 거래처, "단가 (원/kg)", "MOQ (kg)", "리드타임 (일)")
-            VALUES (?, 0, ?, ?, ?, ?, ?)
-        """
-        cursor.execute(insert_sql, (원료명, 유통기한, 거래처, 단가, MOQ, 리드타임))
-        conn.commit()
+    def add_new_ingredient_and_record(conn, 원료명, 유통기한, 거래처, 단가, MOQ, 리드타임, 유형, 수량_g, memo):
+        try:
+            cursor = conn.cursor()
+            # 원료 추가와 거래 기록을 하나의 트랜잭션으로 처리
+            conn.execute("BEGIN IMMEDIATE")
+            # 같은 원료명이 이미 있으면 새로 추가하지 않고 기존 원료에 거래만 기록
+            insert_sql = """
+                INSERT INTO inventory
+                (원료명, "재고량 (g)", 유통기한, 거래처, "단가 (원/kg)", "MOQ (kg)", "리드타임 (일)")
+                SELECT ?, 0, ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (SELECT 1 FROM inventory WHERE 원료명 = ?)
+            """
+            cursor.execute(insert_sql, (원료명, 유통기한, 거래처, 단가, MOQ, 리드타임, 원료명))
+            created = cursor.rowcount > 0
+            write_transaction(cursor, 원료명, 유형, 수량_g, memo)
+
+            conn.commit()
+            bump_data_version("inventory")
+            st.success(f"{유형} 기록 완료! (원료: {원료명}, 수량(g): {수량_g}, 비고: {memo})")
+            if not created:
+                st.warning(
+                    f"'{원료명}'은(는) 이미 등록된 원료이므로 기존 원료에 거래만 기록했습니다. "
+                    "입력한 유통기한/거래처/단가/MOQ/리드타임은 반영되지 않았습니다. "
+                    "원료 정보 수정은 '재고 관리' 메뉴를 이용하세요."
+                )
+
+        except Exception as e:
+            st.error(f"거래 기록 중 오류가 발생했습니다: {e}")
     
     @with_connection
-    def get_inventory_list(conn):
-        df_inv = pd.read_sql("SELECT 원료명 FROM inventory ORDER BY 원료명 ASC", conn)
+    @st.cache_data(ttl=60)
+    def _get_inventory_list(_conn, version):
+        df_inv = pd.read_sql("SELECT 원료명 FROM inventory ORDER BY 원료명 ASC", _conn)
         return df_inv["원료명"].unique().tolist() if not df_inv.empty else []
+
+    def get_inventory_list():
+        return _get_inventory_list(get_data_version().get("inventory", 0))
     
+    def write_transaction(cursor, 원료명, 유형, 수량_g, memo):
+        # 비고 컬럼까지 INSERT
+        transaction_query = """
+            INSERT INTO transactions
+            (원료명, 유형, "수량 (g)", 날짜, 비고)
+            VALUES (?, ?, ?, ?, ?)
+        """
+        cursor.execute(transaction_query, (
+            원료명, 유형, float(num_or_zero(str(수량_g))),
+            datetime.now(), memo
+        ))
+
+        # 재고 테이블 업데이트
+        if 유형 == "입고":
+            update_query = """
+                UPDATE inventory
+                SET "재고량 (g)" = "재고량 (g)" + ?
+                WHERE 원료명 = ?
+            """
+        else:  # 출고
+            update_query = """
+                UPDATE inventory
+                SET "재고량 (g)" = "재고량 (g)" - ?
+                WHERE 원료명 = ?
+            """
+        cursor.execute(update_query, (수량_g, 원료명))
+
     @with_connection
     def record_transaction(conn, 원료명, 유형, 수량_g, memo):
         try:
-            cursor = conn.cursor()
-            # 비고 컬럼까지 INSERT
-            transaction_query = """
-                INSERT INTO transactions
-                (원료명, 유형, "수량 (g)", 날짜, 비고)
-                VALUES (?, ?, ?, ?, ?)
-            """
-            cursor.execute(transaction_query, (
-                원료명, 유형, float(num_or_zero(str(수량_g))),
-                datetime.now(), memo
-            ))
-    
-            # 재고 테이블 업데이트
-            if 유형 == "입고":
-                update_query = """
-                    UPDATE inventory
-                    SET "재고량 (g)" = "재고량 (g)" + ?
-                    WHERE 원료명 = ?
-                """
-            else:  # 출고
-                update_query = """
-                    UPDATE inventory
-                    SET "재고량 (g)" = "재고량 (g)" - ?
-                    WHERE 원료명 = ?
-                """
-            cursor.execute(update_query, (수량_g, 원료명))
+            write_transaction(conn.cursor(), 원료명, 유형, 수량_g, memo)
     
             conn.commit()
+            bump_data_version("inventory")
             st.success(f"{유형} 기록 완료! (원료: {원료명}, 수량(g): {수량_g}, 비고: {memo})")
     
         except Exception as e:
@@ -357,35 +508,35 @@ elif menu == "입출고 기록":
     @with_connection
     def delete_transaction_and_restore_inventory(conn, trans_id):
         cursor = conn.cursor()
-        # 해당 거래 정보 가져오기
-        select_q = 'SELECT 원료명, 유형, "수량 (g)" FROM transactions WHERE id = ?'
-        cursor.execute(select_q, (trans_id,))
-        row = cursor.fetchone()
-        if row:
-            ingr, ttype, amt = row
-            # 재고 복원
-            if ttype == "입고":
-                # 입고를 취소하므로 재고에서 빼기
-                revert_q = """
-                    UPDATE inventory
-                    SET "재고량 (g)" = "재고량 (g)" - ?
-                    WHERE 원료명 = ?
-                """
-            else:  # 출고 취소하므로 재고에 다시 더하기
-                revert_q = """
-                    UPDATE inventory
-                    SET "재고량 (g)" = "재고량 (g)" + ?
-                    WHERE 원료명 = ?
-                """
-            cursor.execute(revert_q, (amt, ingr))
-    
-            # 해당 거래 삭제
-            del_q = "DELETE FROM transactions WHERE id = ?"
-            cursor.execute(del_q, (trans_id,))
+        # 거래 삭제와 재고 복원을 하나의 트랜잭션으로 처리
+        conn.execute("BEGIN IMMEDIATE")
+        if SQLITE_HAS_RETURNING:
+            # 해당 거래를 삭제하면서 거래 정보를 함께 가져오기
+            del_q = 'DELETE FROM transactions WHERE id = ? RETURNING 원료명, 유형, "수량 (g)"'
+            rows = cursor.execute(del_q, (trans_id,)).fetchall()
+        else:
+            # 해당 거래 정보 가져온 뒤 삭제
+            select_q = 'SELECT 원료명, 유형, "수량 (g)" FROM transactions WHERE id = ?'
+            rows = cursor.execute(select_q, (trans_id,)).fetchall()
+            if rows:
+                cursor.execute("DELETE FROM transactions WHERE id = ?", (trans_id,))
+
+        if rows:
+            ingr, ttype, amt = rows[0]
+            # 재고 복원: 입고를 취소하면 재고에서 빼고, 출고를 취소하면 재고에 다시 더함
+            # (엑셀 업로드로 들어온 수량이 비어 있는(NULL) 거래는 0으로 취급)
+            revert_q = """
+                UPDATE inventory
+                SET "재고량 (g)" = "재고량 (g)" + CASE WHEN ? = '입고' THEN -COALESCE(?, 0) ELSE COALESCE(?, 0) END
+                WHERE 원료명 = ?
+            """
+            cursor.execute(revert_q, (ttype, amt, amt, ingr))
     
             conn.commit()
+            bump_data_version("inventory")
             st.success(f"거래 ID {trans_id} 삭제, 재고 복원 완료!")
         else:
+            conn.rollback()
             st.error("해당 거래 ID를 찾을 수 없습니다.")
     
       
@@ -431,15 +582,17 @@ elif menu == "입출고 기록":
             if not new_ingr_name.strip():
                 st.warning("원료명을 입력하세요.")
             else:
-                add_new_ingredient(
+                add_new_ingredient_and_record(
                     원료명=new_ingr_name.strip(),
                     유통기한=str(new_ingr_date) if new_ingr_date else None,
                     거래처=final_vendor,  # 최종 선택된 거래처 사용
                     단가=new_ingr_price,
                     MOQ=new_ingr_moq,
-                    리드타임=new_ingr_lead
+                    리드타임=new_ingr_lead,
+                    유형=ttype2,
+                    수량_g=amt2,
+                    memo=memo_new
                 )
-                record_transaction(new_ingr_name.strip(), ttype2, amt2, memo_new)
 
 
     st.subheader("입출고 이력")
@@ -457,16 +610,15 @@ elif menu == "유통기한 관리":
 
     @with_connection
     def display_expiring_items(conn, days):
-        query = "SELECT * FROM inventory WHERE 유통기한 IS NOT NULL"
-        df = pd.read_sql(query, conn)
-        df["유통기한"] = pd.to_datetime(df["유통기한"], errors="coerce")
+        # 임박 기준일 이내의 원료만 DB에서 바로 걸러서 가져옴
+        query = "SELECT * FROM inventory WHERE 유통기한 IS NOT NULL AND 유통기한 <= ?"
         warning_date = datetime.now() + timedelta(days=days)
-        return df[df["유통기한"] <= warning_date]
+        return pd.read_sql(query, conn, params=(warning_date.isoformat(sep=" "),))
 
     st.subheader("임박 원료 조회")
     days = st.slider("임박 기준 일수", min_value=1, max_value=365, value=30)
     expiring_df = display_expiring_items(days)
-    # "유통기한" 컬럼이 datetime 타입이면, YYYY-MM-DD 형식의 문자열로 변환
+    # "유통기한" 컬럼을 YYYY-MM-DD 형식의 문자열로 변환
     if not expiring_df.empty and "유통기한" in expiring_df.columns:
         expiring_df["유통기한"] = pd.to_datetime(expiring_df["유통기한"], errors="coerce").dt.strftime("%Y-%m-%d")
     st.dataframe(expiring_df)
@@ -480,21 +632,40 @@ elif menu == "생산 가능량 계산":
     # 세션 상태 초기화
     if "calc_done" not in st.session_state:
         st.session_state.calc_done = False
-        st.session_state.used_table = []
+        st.session_state.usage_df = None
         st.session_state.sufficient = False
 
     @with_connection
-    def get_product_list(conn):
-        return pd.read_sql("SELECT DISTINCT 제품명 FROM formula", conn)["제품명"].tolist()
+    @st.cache_data(ttl=60)
+    def _get_product_list(_conn, version):
+        return pd.read_sql("SELECT DISTINCT 제품명 FROM formula", _conn)["제품명"].tolist()
+
+    def get_product_list():
+        return _get_product_list(get_data_version().get("formula", 0))
 
 
     @with_connection
-    def get_inventory_df(conn):
-        return pd.read_sql("SELECT * FROM inventory", conn)
+    def get_production_requirements(conn, product_name, unit_capacity, total_quantity):
+        # 처방 원료별 필요량과 원료명별 재고 합계를 DB에서 한 번에 계산
+        return pd.read_sql(
+            """SELECT
+                f.원료명,
+                f."사용량 (g/%)" * ? * ? AS "필요량(g)",
+                COALESCE(
+                    (SELECT SUM(i."재고량 (g)") FROM inventory i WHERE i.원료명 = f.원료명), 0.0
+                ) AS "현재재고(g)"
+            FROM formula f
+            WHERE f.제품명 = ?
+            ORDER BY f.id""",
+            conn, params=(unit_capacity, total_quantity, product_name)
+        )
 
     @with_connection
     def insert_production_history(conn, 제품명, 용량_g, 수량, used_materials):
         cursor = conn.cursor()
+        # 이력 기록과 재고 차감을 하나의 트랜잭션으로 처리
+        conn.execute("BEGIN IMMEDIATE")
+
         # production_history에 기록
         insert_sql = """
             INSERT INTO production_history (제품명, "용량 (g)", 수량, 날짜)
@@ -504,15 +675,15 @@ elif menu == "생산 가능량 계산":
         new_id = cursor.lastrowid
 
         # 재고 차감
-        for (ingredient, used_qty) in used_materials:
-            upd_sql = """
-                UPDATE inventory
-                SET "재고량 (g)" = "재고량 (g)" - ?
-                WHERE 원료명 = ?
-            """
-            cursor.execute(upd_sql, (used_qty, ingredient))
+        upd_sql = """
+            UPDATE inventory
+            SET "재고량 (g)" = "재고량 (g)" - ?
+            WHERE 원료명 = ?
+        """
+        cursor.executemany(upd_sql, [(used_qty, ingredient) for ingredient, used_qty in used_materials])
 
         conn.commit()
+        bump_data_version("inventory")
         return new_id
 
     product_list = get_product_list()
@@ -531,46 +702,33 @@ elif menu == "생산 가능량 계산":
 
             # (1) 생산 가능량 계산
             if st.button("생산 가능량 계산"):
-                inv_df = get_inventory_df()
-                used_table = []  # [(원료명, 필요량, 보유량)]
-                sufficient = True
-
-                for _, row in formula_df.iterrows():
-                    ingredient = row["원료명"]
-                    usage_per_unit = row["사용량 (g/%)"]
-                    required_qty = usage_per_unit * unit_capacity * total_quantity
+                usage_df = get_production_requirements(product_name, unit_capacity, total_quantity)
 
-                    current_stock = inv_df.loc[inv_df["원료명"] == ingredient, "재고량 (g)"].sum()
-                    used_table.append((ingredient, required_qty, current_stock))
-
-                    if current_stock < required_qty:
-                        st.error(f"{ingredient} 재고 부족 -> 필요 {required_qty}g, 보유 {current_stock}g")
-                        sufficient = False
+                shortage_df = usage_df[usage_df["현재재고(g)"] < usage_df["필요량(g)"]]
+                for ingredient, required_qty, current_stock in shortage_df.itertuples(index=False, name=None):
+                    st.error(f"{ingredient} 재고 부족 -> 필요 {required_qty}g, 보유 {current_stock}g")
 
                 # 세션 상태에 저장
                 st.session_state.calc_done = True
-                st.session_state.used_table = used_table
-                st.session_state.sufficient = sufficient
+                st.session_state.usage_df = usage_df
+                st.session_state.sufficient = shortage_df.empty
 
             # 계산 후 표시
             if st.session_state.calc_done:
                 # 화면에 사용량 테이블 표시
-                usage_df = pd.DataFrame(
-                    [(x[0], x[1], x[2]) for x in st.session_state.used_table],
-                    columns=["원료명", "필요량(g)", "현재재고(g)"]
-                )
+                usage_df = st.session_state.usage_df
                 st.write("원료별 사용량 계산 결과:")
                 st.dataframe(usage_df)
 
                 # (2) 충분하면 생산 진행 확인
                 if st.session_state.sufficient:
                     if st.button("생산 진행 확인"):
-                        used_materials = [(x[0], x[1]) for x in st.session_state.used_table]
+                        used_materials = list(zip(usage_df["원료명"], usage_df["필요량(g)"]))
                         new_id = insert_production_history(product_name, unit_capacity, total_quantity, used_materials)
                         st.success(f"{product_name} {total_quantity}개 생산 완료! (ID={new_id})")
                         # 재설정 (버튼 누른 뒤 UI를 초기화)
                         st.session_state.calc_done = False
-                        st.session_state.used_table = []
+                        st.session_state.usage_df = None
                         st.session_state.sufficient = False
 
 
@@ -588,23 +746,24 @@ elif menu == "엑셀 동기화":
     if uploaded_file:
         if st.button("업로드 실행 (엑셀 -> DB)"):
             try:
-                import sqlite3
-                # 미리 정해진 시트명에 따라 엑셀 파일의 데이터를 읽어옵니다.
-                df_inv = pd.read_excel(uploaded_file, sheet_name="재고", engine="openpyxl")
-                df_for = pd.read_excel(uploaded_file, sheet_name="처방", engine="openpyxl")
-                df_trans = pd.read_excel(uploaded_file, sheet_name="입출고", engine="openpyxl")
-                df_prod = pd.read_excel(uploaded_file, sheet_name="생산이력", engine="openpyxl")
-
-                # 하나의 DB 연결을 열어서 모든 시트의 데이터를 업데이트합니다.
-                conn = sqlite3.connect(DB_NAME)
-                try:
-                    sync_sheet_to_db(conn, df_inv, "inventory")
-                    sync_sheet_to_db(conn, df_for, "formula")
-                    sync_sheet_to_db(conn, df_trans, "transactions")
-                    sync_sheet_to_db(conn, df_prod, "production_history")
-                finally:
-                    conn.commit()
-                    conn.close()
+                # 미리 정해진 시트명에 따라 엑셀 파일의 데이터를 한 번에 읽어옵니다.
+                # (시트마다 따로 읽으면 xlsx 압축 해제/파싱이 시트 수만큼 반복됨)
+                sheets = pd.read_excel(uploaded_file, sheet_name=list(SHEET_TABLE_MAP), engine="openpyxl")
+
+                # 하나의 DB 연결로 모든 시트의 데이터를 업데이트합니다.
+                with get_db_lock():
+                    conn = get_conn()
+                    # 모든 시트를 하나의 트랜잭션으로 반영 (중간에 실패하면 전체 취소)
+                    conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        for sheet_name, table_name in SHEET_TABLE_MAP.items():
+                            sync_sheet_to_db(conn, sheets[sheet_name], table_name)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                    checkpoint_db(conn)
+                    bump_data_version(*SHEET_TABLE_MAP.values())
 
                 st.success("엑셀 업로드 및 DB 반영이 완료되었습니다.")
             except Exception as e:
@@ -613,32 +772,23 @@ elif menu == "엑셀 동기화":
     # (2) DB -> Excel 내보내기
     if st.button("내보내기 실행 (DB -> Excel)"):
         try:
-            import openpyxl
-            with pd.ExcelWriter("exported_data.xlsx", engine="openpyxl") as writer:
-                conn = sqlite3.connect(DB_NAME)
-                try:
-                    db_to_sheet(conn, "inventory", "재고", writer)
-                    db_to_sheet(conn, "formula", "처방", writer)
-                    db_to_sheet(conn, "transactions", "입출고", writer)
-                    db_to_sheet(conn, "production_history", "생산이력", writer)
-                finally:
-                    conn.close()
-                
-                # 모든 시트의 상태를 visible로 설정
-                wb = writer.book
-                for sheet in wb.worksheets:
-                    sheet.sheet_state = 'visible'
-                
-                if "Sheet" in wb.sheetnames and len(wb.sheetnames) > 1:
-                    wb.remove(wb["Sheet"])
-            
+            wb = Workbook(write_only=True)
+            with get_db_lock():
+                conn = get_conn()
+                for sheet_name, table_name in SHEET_TABLE_MAP.items():
+                    db_to_sheet(conn, table_name, sheet_name, wb)
+                checkpoint_db(conn)
+            # 임시 파일 없이 메모리 버퍼에 저장한 뒤 바로 다운로드 데이터로 전달
+            buf = io.BytesIO()
+            wb.save(buf)
+
             # 파일명: [YY-MM-DD 원료 재고 및 생산일지.xlsx]
             filename = f"{datetime.now().strftime('%y-%m-%d')} 원료 재고 및 생산일지.xlsx"
             
             st.success("엑셀 파일이 생성되었습니다. 아래 버튼을 눌러 다운로드하세요.")
             st.download_button(
                 "엑셀 다운로드", 
-                data=open("exported_data.xlsx", "rb").read(),
+                data=buf.getvalue(),
                 file_name=filename,
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )
@@ -692,14 +842,9 @@ elif menu == "생산 히스토리":
                 st.warning("처방이 없습니다.")
             else:
                 # 원료별 사용량 = formula["사용량 (g/%)"] * unit_capacity * total_qty
-                detail_rows = []
-                for _, rowf in f_df.iterrows():
-                    ingr = rowf["원료명"]
-                    usage_per_unit = rowf["사용량 (g/%)"]
-                    needed = usage_per_unit * unit_capacity * total_qty
-                    detail_rows.append((ingr, usage_per_unit, needed))
-
-                detail_df = pd.DataFrame(detail_rows, columns=["원료명", "처방 (g/%)", "실제 사용량(g)"])
+                detail_df = f_df.assign(
+                    **{"실제 사용량(g)": f_df["사용량 (g/%)"] * unit_capacity * total_qty}
+                ).rename(columns={"사용량 (g/%)": "처방 (g/%)"})
                 st.write("이 생산에 사용된 구체적 원료 내역:")
                 st.dataframe(detail_df)
 
@@ -713,6 +858,8 @@ elif menu == "생산 히스토리":
         5) production_history 행 삭제
         """
         cursor = conn.cursor()
+        # 조회 ~ 복원 ~ 삭제를 하나의 트랜잭션으로 처리
+        conn.execute("BEGIN IMMEDIATE")
 
         # 1) 해당 히스토리 조회
         select_q = """SELECT 제품명, "용량 (g)" as 용량, 수량
@@ -730,21 +877,19 @@ elif menu == "생산 히스토리":
             return False, f"'{product_name}'에 대한 처방이 없어 복원이 불가능합니다."
 
         # 3) 실제 사용량 계산
-        for _, r in df_formula.iterrows():
-            ingr = r["원료명"]
-            usage_per_unit = r["사용량 (g/%)"]
-            used_amount = usage_per_unit * unit_capacity * total_qty
+        used_amounts = df_formula["사용량 (g/%)"] * unit_capacity * total_qty
 
-            # 4) inventory 복원
-            upd_q = """UPDATE inventory
-                    SET "재고량 (g)" = "재고량 (g)" + ?
-                    WHERE 원료명 = ?"""
-            cursor.execute(upd_q, (used_amount, ingr))
+        # 4) inventory 복원
+        upd_q = """UPDATE inventory
+                SET "재고량 (g)" = "재고량 (g)" + ?
+                WHERE 원료명 = ?"""
+        cursor.executemany(upd_q, zip(used_amounts.tolist(), df_formula["원료명"]))
 
         # 5) 생산 히스토리 삭제
         del_q = "DELETE FROM production_history WHERE id = ?"
         cursor.execute(del_q, (hist_id,))
         conn.commit()
+        bump_data_version("inventory")
 
         return True, f"ID={hist_id} 생산 이력을 삭제하고 재고를 복원했습니다."
 